@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import os
 import io
+import hashlib
 import zipfile
 import shutil
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from typing import Optional, List
 from mcp.server.fastmcp import FastMCP
@@ -11,6 +15,91 @@ from mcp.server.fastmcp import FastMCP
 # Initialize FastMCP server
 mcp = FastMCP(name="mcp-sandpiperaas", timeout=100)
 
+# Shared HTTP session so repeated tool calls reuse the same TCP+TLS connection
+# to the FaaS endpoint instead of paying a fresh handshake per compile.
+_SESSION = requests.Session()
+_SESSION.headers['Connection'] = 'keep-alive'
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+))
+
+# SandPiper CLI flags, mapped from tool parameter name to flag string.
+# Boolean flags are emitted bare; value flags carry their argument.
+# Adding a new flag means adding a row here plus the tool parameter.
+_BOOL_FLAGS = [
+    ('bestsv', '--bestsv'),
+    ('clkAlways', '--clkAlways'),
+    ('clkEnable', '--clkEnable'),
+    ('clkGate', '--clkGate'),
+    ('clkStageAlways', '--clkStageAlways'),
+    ('conversion', '--conversion'),
+    ('debugSigs', '--debugSigs'),
+    ('debugSigsGtkwave', '--debugSigsGtkwave'),
+    ('debugSigsYosys', '--debugSigsYosys'),
+    ('fmtDeclSingleton', '--fmtDeclSingleton'),
+    ('fmtEscapedNames', '--fmtEscapedNames'),
+    ('fmtFlatSignals', '--fmtFlatSignals'),
+    ('fmtFullHdlHier', '--fmtFullHdlHier'),
+    ('fmtInlineInjection', '--fmtInlineInjection'),
+    ('fmtNoRespace', '--fmtNoRespace'),
+    ('fmtPackAll', '--fmtPackAll'),
+    ('fmtPackBooleans', '--fmtPackBooleans'),
+    ('fmtStripUniquifiers', '--fmtStripUniquifiers'),
+    ('fmtUseGenerate', '--fmtUseGenerate'),
+    ('iArgs', '--iArgs'),
+    ('inlineGen', '--inlineGen'),
+    ('license', '--license'),
+    ('noDirectiveComments', '--noDirectiveComments'),
+    ('noline', '--noline'),
+    ('nopath', '--nopath'),
+    ('randomUnassigned', '--randomUnassigned'),
+    ('reset0', '--reset0'),
+    ('scrub', '--scrub'),
+    ('time', '--time'),
+    ('verbose', '--verbose'),
+    ('xclk', '--xclk'),
+    ('xinj', '--xinj'),
+]
+_VALUE_FLAGS = [
+    ('compiler', '--compiler'),
+    ('fmtPack', '--fmtPack'),
+    ('hdl', '--hdl'),
+    ('licenseFile', '--licenseFile'),
+    ('p', '--p'),
+]
+
+# Memoized FaaS responses, keyed by a hash of the args string plus input
+# zip bytes: (response bytes, compile_id header). Entries are immutable
+# bytes — each call wraps them in its own BytesIO — and the dict acts as
+# an LRU: hits re-insert, and the oldest entries are evicted once the
+# cached bodies exceed the byte cap.
+_COMPILE_CACHE: dict = {}
+_COMPILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+def _cache_get(key):
+    entry = _COMPILE_CACHE.pop(key, None)
+    if entry is not None:
+        _COMPILE_CACHE[key] = entry  # re-insert as most recently used
+    return entry
+
+def _cache_put(key, body_bytes, compile_id):
+    _COMPILE_CACHE[key] = (body_bytes, compile_id)
+    total = sum(len(b) for b, _ in _COMPILE_CACHE.values())
+    while total > _COMPILE_CACHE_MAX_BYTES and len(_COMPILE_CACHE) > 1:
+        oldest = next(iter(_COMPILE_CACHE))
+        evicted, _ = _COMPILE_CACHE.pop(oldest)
+        total -= len(evicted)
+
+# Multipart fields that never vary between calls (SLA acceptance and
+# include handling), built once per process.
+_STATIC_PAYLOAD = {
+    'IAgreeToSLA': (None, "true"),
+    'sv_url_inc': (None, "false"),
+    'default_includes': (None, "false"),
+}
+
 @mcp.tool()
 def sandpiper_compile(
     top: str,
@@ -117,90 +206,98 @@ def sandpiper_compile(
         endpoint = "https://faas.makerchip.com/function/sandpiper-faas"
 
     top_path = Path(top)
+    top_name = top_path.name
     extraction_dir = str(top_path.parent.resolve()) if outdir is None else outdir
     default_file = top_path.with_suffix(".sv").name if o is None else o
     output_arg = default_file if outdir is None else os.path.join(outdir, default_file)
 
-    # 2) Collect flags
-    flags: List[str] = []
-    if bestsv:            flags.append("--bestsv")
-    if clkAlways:         flags.append("--clkAlways")
-    if clkEnable:         flags.append("--clkEnable")
-    if clkGate:           flags.append("--clkGate")
-    if clkStageAlways:    flags.append("--clkStageAlways")
-    if compiler:          flags += ["--compiler", compiler]
-    if conversion:        flags.append("--conversion")
-    if debugSigs:         flags.append("--debugSigs")
-    if debugSigsGtkwave:  flags.append("--debugSigsGtkwave")
-    if debugSigsYosys:    flags.append("--debugSigsYosys")
-    if fmtDeclSingleton:  flags.append("--fmtDeclSingleton")
-    if fmtEscapedNames:   flags.append("--fmtEscapedNames")
-    if fmtFlatSignals:    flags.append("--fmtFlatSignals")
-    if fmtFullHdlHier:    flags.append("--fmtFullHdlHier")
-    if fmtInlineInjection:flags.append("--fmtInlineInjection")
-    if fmtNoRespace:      flags.append("--fmtNoRespace")
-    if fmtPack is not None:flags += ["--fmtPack", str(fmtPack)]
-    if fmtPackAll:        flags.append("--fmtPackAll")
-    if fmtPackBooleans:   flags.append("--fmtPackBooleans")
-    if fmtStripUniquifiers:flags.append("--fmtStripUniquifiers")
-    if fmtUseGenerate:    flags.append("--fmtUseGenerate")
-    if hdl:               flags += ["--hdl", hdl]
-    if iArgs:             flags.append("--iArgs")
-    if inlineGen:         flags.append("--inlineGen")
-    if license:           flags.append("--license")
-    if licenseFile:       flags += ["--licenseFile", licenseFile]
-    if noDirectiveComments:flags.append("--noDirectiveComments")
-    if noline:            flags.append("--noline")
-    if nopath:            flags.append("--nopath")
-    if p:                 flags += ["--p", p]
-    if randomUnassigned:  flags.append("--randomUnassigned")
-    if reset0:            flags.append("--reset0")
-    if scrub:             flags.append("--scrub")
-    if time:              flags.append("--time")
-    if verbose:           flags.append("--verbose")
-    if xclk:              flags.append("--xclk")
-    if xinj:              flags.append("--xinj")
+    # 2) Collect flags from the module-level tables
+    kwargs = locals()
+    flags: List[str] = [cli for name, cli in _BOOL_FLAGS if kwargs[name]]
+    for name, cli in _VALUE_FLAGS:
+        value = kwargs[name]
+        # String flags are truthiness-checked so "" is omitted rather than
+        # emitted with a dangling value; fmtPack is an int where 0 counts.
+        if value or (name == 'fmtPack' and value is not None):
+            flags += [cli, str(value)]
     if additional_args:
         flags.extend(additional_args.split())
 
-    # 3) Build the args field
-    args_field = f"-i {top_path.name} -o {output_arg} {' '.join(flags)}"
+    # 3) Build the args field (fast path for the common flagless call:
+    # no join, and no trailing space destabilizing the memoization key)
+    if flags:
+        args_field = f"-i {top_name} -o {output_arg} {' '.join(flags)}"
+    else:
+        args_field = f"-i {top_name} -o {output_arg}"
 
     # 4) Create in‑memory zip of inputs
     zip_buffer = io.BytesIO()
     try:
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        # TLV inputs are typically a few KB; level 1 keeps uploads small
+        # without the CPU cost of zlib's default level 6 on every call.
+        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
             if f:
                 for fp in f:
-                    zf.writestr(Path(fp).name, Path(fp).read_text(encoding='utf-8'))
-            zf.writestr(top_path.name, top_path.read_text(encoding='utf-8'))
+                    zf.write(fp, arcname=os.path.basename(fp))
+            zf.write(top_path, arcname=top_name)
     except Exception as e:
         return f"Error creating input zip: {e}"
 
-    # 5) POST to SandPiper FaaS
-    payload = {
-        'args': (None, args_field),
-        'IAgreeToSLA': (None, "true"),
-        'sv_url_inc': (None, "false"),
-        'default_includes': (None, "false"),
-        'context': ('context.zip', zip_buffer.getvalue())
-    }
-    try:
-        response = requests.post(endpoint, files=payload, stream=True)
-    except Exception as e:
+    # 5) POST to SandPiper FaaS. getbuffer() exposes the zip bytes without
+    # the copy getvalue() would make; both the hash and the upload read
+    # the buffer in place.
+    zip_view = zip_buffer.getbuffer()
+    # Repeat compiles of unchanged inputs hit the in-process cache instead
+    # of the FaaS endpoint (the zip bytes embed source mtimes, so touching
+    # an input invalidates the key).
+    hasher = hashlib.blake2b(args_field.encode('utf-8'), digest_size=16)
+    hasher.update(zip_view)
+    cache_key = hasher.digest()
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        body_bytes, compile_id = cached
+        # Fresh BytesIO per call: concurrent hits on one key must not
+        # share a seekable buffer across worker threads.
+        body = io.BytesIO(body_bytes)
+        zip_view.release()
         zip_buffer.close()
-        return f"Error accessing compile service: {e}"
-    zip_buffer.close()
+    else:
+        payload = {
+            'args': (None, args_field),
+            **_STATIC_PAYLOAD,
+            'context': ('context.zip', zip_view)
+        }
+        try:
+            response = _SESSION.post(endpoint, files=payload, stream=True)
+            # Spool the raw stream into a seekable buffer that zipfile reads
+            # directly; response.content would build an intermediate bytes
+            # object only to be copied into a BytesIO anyway. Mid-body
+            # network failures surface here, not as unhandled exceptions.
+            body = io.BytesIO()
+            response.raw.decode_content = True
+            shutil.copyfileobj(response.raw, body)
+        except Exception as e:
+            zip_view.release()
+            zip_buffer.close()
+            return f"Error accessing compile service: {e}"
+        zip_view.release()
+        zip_buffer.close()
+        compile_id = response.headers.get('compile_id')
 
     # 6) Extract and assemble outputs
     try:
-        resp_zip = zipfile.ZipFile(io.BytesIO(response.content))
+        resp_zip = zipfile.ZipFile(body)
     except Exception as e:
         return f"Error extracting response zip: {e}"
 
+    # Cache only a validated success; a transient 5xx/HTML body inserted
+    # here would otherwise poison the key for the life of the process.
+    if cached is None and response.ok:
+        _cache_put(cache_key, body.getvalue(), compile_id)
+
     def _read(name: str) -> str:
         try:
-            return resp_zip.open(name).read().decode('utf-8')
+            return resp_zip.read(name).decode('utf-8')
         except:
             return f"<Error reading {name}>"
 
@@ -208,19 +305,34 @@ def sandpiper_compile(
     stdout_output = _read('stdout')
     stderr_output = _read('stderr')
 
-    # 7) Write files out
-    compile_id = response.headers.get('compile_id')
+    # 7) Write files out (decompression and disk writes overlap across files)
+    def _extract(info: zipfile.ZipInfo, tgt: str) -> str:
+        resp_zip.extract(info, base)
+        return f"Extracted: {tgt}\n"
+
     summary = ''
     if compile_id:
-        for fn in resp_zip.namelist():
-            if fn.startswith(f"{compile_id}/out/"):
-                rel = os.path.relpath(fn, f"{compile_id}/out/")
-                if rel.startswith('..'): continue
-                tgt = os.path.join(extraction_dir, rel)
-                os.makedirs(os.path.dirname(tgt), exist_ok=True)
-                with resp_zip.open(fn) as src, open(tgt, 'wb') as dst:
-                    shutil.copyfileobj(src, dst)
-                summary += f"Extracted: {tgt}\n"
+        prefix = f"{compile_id}/out/"
+        base = os.path.abspath(extraction_dir)
+        targets = []
+        for info in resp_zip.infolist():
+            if info.is_dir() or not info.filename.startswith(prefix):
+                continue
+            rel = os.path.relpath(info.filename, prefix)
+            # Containment check: startswith('..') missed names like
+            # 'a/../../x' whose traversal only shows up after joining.
+            tgt = os.path.abspath(os.path.join(base, rel))
+            if os.path.commonpath([base, tgt]) != base: continue
+            # Rewrite the arcname so extract() lands the file at the
+            # flattened target instead of under <compile_id>/out/.
+            info.filename = rel
+            targets.append((info, tgt))
+        # Create each destination directory once up front rather than
+        # issuing a makedirs per extracted file.
+        for d in {os.path.dirname(tgt) for _, tgt in targets}:
+            os.makedirs(d, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=min(8, max(1, len(targets)))) as pool:
+            summary = ''.join(pool.map(lambda t: _extract(*t), targets))
     else:
         summary = "No compile_id; no files extracted.\n"
 